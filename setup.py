@@ -20,10 +20,10 @@ if not os.getenv("READTHEDOCS"):
         keywords=["STEM", "EELS", "4D-STEM", "electron microscopy"],
         zip_safe=False,
         install_requires=[
-            "pyfftw >= 0.10.3",
+            "pyfftw >= 0.12.0",
             "pywavelets >= 0.5.2",
             "numpy >= 1.13.0",
-            "scipy >= 1.0.0",
+            "scipy >= 1.4.0",
             "matplotlib >= 2.2.0",
             "pillow > 5.0.0",
             "numba >= 0.45.0",
@@ -35,7 +35,7 @@ def fit_nbed_disks(corr_image, disk_size, positions, diff_spots):
 
 
 def sobel_filter(image, med_filter=50):
-    ls_image, _ = st.util.sobel(st.util.image_logarizer(image))
+    ls_image = st.util.log_sobel_magnitude(image)
     ls_image[ls_image > (med_filter * np.median(ls_image))] = med_filter * np.median(
         ls_image
     )
@@ -76,7 +76,7 @@ def strain_and_disk(data4D, disk_size, pixel_list_xy, disk_list, ROI=1, med_fact
 
     # Calculate for mean CBED if no reference
     mean_cbed = np.mean(data4D, axis=(-1, -2), dtype=np.float64)
-    mean_ls_cbed, _ = st.util.sobel(st.util.image_logarizer(mean_cbed))
+    mean_ls_cbed = st.util.log_sobel_magnitude(mean_cbed)
     mean_ls_cbed[
         mean_ls_cbed > med_factor * np.median(mean_ls_cbed)
     ] = med_factor * np.median(mean_ls_cbed)
@@ -95,7 +95,7 @@ def strain_and_disk(data4D, disk_size, pixel_list_xy, disk_list, ROI=1, med_fact
         ii = scan_positions[0, pp]
         jj = scan_positions[1, pp]
         pattern = data4D[:, :, ii, jj]
-        pattern_ls, _ = st.util.sobel(st.util.image_logarizer(pattern))
+        pattern_ls = st.util.log_sobel_magnitude(pattern)
         pattern_ls[pattern_ls > med_factor * np.median(pattern_ls)] = np.median(
             pattern_ls
         )
@@ -1,8 +1,8 @@
 import numpy as np
 import pywt
-import numba
+import concurrent.futures as cf
 import scipy.optimize as spo
-import scipy.signal as scisig
+import scipy.ndimage as scnd
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 
@@ -13,7 +13,7 @@ def cleanEELS_wavelet(data, threshold):
     coeffs = pywt.wavedec(data, "sym4", level=max_level)
     coeffs2 = coeffs
     threshold = 0.1
-    for ii in numba.prange(1, len(coeffs)):
+    for ii in range(1, len(coeffs)):
         coeffs2[ii] = pywt.threshold(coeffs[ii], threshold * np.amax(coeffs[ii]))
     data2 = pywt.waverec(coeffs2, "sym4")
     return data2
@@ -24,24 +24,27 @@ def cleanEELS_3D(data3D, method, threshold=0):
     cleaned_3D = np.zeros(data_shape)
     if method == "wavelet":
         if threshold > 0:
-            for ii in range(data_shape[2]):
-                for jj in range(data_shape[1]):
-                    cleaned_3D[:, jj, ii] = cleanEELS_wavelet(
-                        data3D[:, jj, ii], threshold
-                    )
+            positions = list(np.ndindex(data_shape[2], data_shape[1]))
+            with cf.ThreadPoolExecutor() as executor:
+                cleaned_spectra = executor.map(
+                    lambda pos: cleanEELS_wavelet(data3D[:, pos[1], pos[0]], threshold),
+                    positions,
+                )
+                for (ii, jj), cleaned_spectrum in zip(positions, cleaned_spectra):
+                    cleaned_3D[:, jj, ii] = cleaned_spectrum
         else:
             cleaned_3D = data3D
     if method == "median":
         if threshold > 0:
-            for ii in range(data_shape[2]):
-                for jj in range(data_shape[1]):
-                    cleaned_3D[:, jj, ii] = scisig.medfilt(data3D[:, jj, ii], threshold)
+            cleaned_3D = scnd.median_filter(
+                data3D, size=(int(threshold), 1, 1), mode="nearest"
+            )
         else:
             cleaned_3D = data3D
     return cleaned_3D
 
 
-def powerlaw_fit(xdata, ydata, xrange):
+def powerlaw_fit(xdata, ydata, xrange, dx=None):
     """
     Power Law Fiiting of EELS spectral data
     
@@ -50,18 +53,26 @@ def powerlaw_fit(xdata, ydata, xrange):
     xdata:  ndarray
             energy values in electron-volts
     ydata:  ndarray
-            intensity values in A.U.
+            intensity values in A.U. The first
+            dimension is the energy axis, and any
+            further dimensions are independent 
+            spectra that are fitted together
     xrange: ndarray
             Starting and stopping energy values 
             in electron volts
+    dx:     float, optional
+            Energy step of xdata. If None, it is 
+            calculated as the median step of xdata.
+            Pass it when fitting repeatedly with the
+            same xdata
                 
     Returns
     -------
     fitted: ndarray
             Background from the region of xdata
-    power:  float
+    power:  float or ndarray
             The power term
-    const:  float
+    const:  float or ndarray
             Constant of multiplication
                 
     Notes
@@ -72,23 +83,38 @@ def powerlaw_fit(xdata, ydata, xrange):
     values and the energy loss values, taking care to 
     to only take the log of non-negative intensity
     values to prevent imaginary numbers from occuring.
-    We then do a linear polynomial fit in numpy, and 
-    return the power law fitted data, power and the 
-    multiplicative constant. Since the fitting is done 
-    in log-log space, we have to take the exponential
-    of the intercept to get the multiplicative constant.
+    We then do a closed form linear least squares fit 
+    of the log values, and return the power law fitted 
+    data, power and the multiplicative constant. Since 
+    the fitting is done in log-log space, we have to 
+    take the exponential of the intercept to get the 
+    multiplicative constant. If ydata has more than
+    one dimension, every spectrum is fitted at once with
+    the positive value mask applied along the energy axis.
                  
     :Authors:
     Jordan Hachtel <hachtelja@ornl.gov>
     
     """
-    start_val = np.int((xrange[0] - np.amin(xdata)) / (np.median(np.diff(xdata))))
-    stop_val = np.int((xrange[1] - np.amin(xdata)) / (np.median(np.diff(xdata))))
-    xlog = np.log(xdata[start_val:stop_val][np.where(ydata[start_val:stop_val] > 0)])
-    ylog = np.log(ydata[start_val:stop_val][np.where(ydata[start_val:stop_val] > 0)])
-    power, const = np.polyfit(xlog, ylog, 1)
-    const = np.exp(const)
-    fitted = const * (xdata ** power)
+    if dx is None:
+        dx = np.median(np.diff(xdata))
+    start_val = int((xrange[0] - np.amin(xdata)) / dx)
+    stop_val = int((xrange[1] - np.amin(xdata)) / dx)
+    spectra_shape = (-1,) + ((1,) * (np.ndim(ydata) - 1))
+    xfit = np.reshape(xdata[start_val:stop_val], spectra_shape)
+    yfit = ydata[start_val:stop_val]
+    positive = yfit > 0
+    no_positive = np.sum(positive, axis=0)
+    xlog = np.log(np.where(positive, xfit, 1))
+    ylog = np.log(np.where(positive, yfit, 1))
+    xlog_mean = np.sum(xlog * positive, axis=0) / no_positive
+    ylog_mean = np.sum(ylog * positive, axis=0) / no_positive
+    xlog_dev = (xlog - xlog_mean) * positive
+    power = np.sum(xlog_dev * (ylog - ylog_mean), axis=0) / np.sum(
+        xlog_dev ** 2, axis=0
+    )
+    const = np.exp(ylog_mean - (power * xlog_mean))
+    fitted = const * (np.reshape(xdata, spectra_shape) ** power)
     return fitted, power, const
 
 
@@ -127,11 +153,13 @@ def powerlaw_plot(
     return fitted_data
 
 
-def region_intensity(xdata, ydata, xrange, peak_range, showdata=True):
-    fitted_data, _, _ = powerlaw_fit(xdata, ydata, xrange)
+def region_intensity(xdata, ydata, xrange, peak_range, showdata=True, dx=None):
+    if dx is None:
+        dx = np.median(np.diff(xdata))
+    fitted_data, _, _ = powerlaw_fit(xdata, ydata, xrange, dx)
     subtracted_data = ydata - fitted_data
-    start_val = np.int((peak_range[0] - np.amin(xdata)) / (np.median(np.diff(xdata))))
-    stop_val = np.int((peak_range[1] - np.amin(xdata)) / (np.median(np.diff(xdata))))
+    start_val = int((peak_range[0] - np.amin(xdata)) / dx)
+    stop_val = int((peak_range[1] - np.amin(xdata)) / dx)
     data_floor = np.amin(subtracted_data[start_val:stop_val])
     peak_sum = np.sum(subtracted_data[start_val:stop_val] - data_floor)
     yrange = np.zeros_like(peak_range)
@@ -159,42 +187,44 @@ def region_intensity(xdata, ydata, xrange, peak_range, showdata=True):
     return peak_sum
 
 
-@numba.jit
 def eels_3D(eels_dict, fit_range, peak_range, LBA_radius=3):
     fit_range = np.asarray(fit_range)
     peak_range = np.asarray(peak_range)
     no_elements = len(peak_range)
-    eels_array = eels_dict["data"]
+    eels_array = np.ascontiguousarray(eels_dict["data"])
     elemental_subtracted = np.zeros(
         (eels_array.shape[0], eels_array.shape[1], eels_array.shape[2], no_elements),
-        dtype=np.float64,
+        dtype=np.float32,
     )
-    yy, xx = np.mgrid[0 : eels_array.shape[1], 0 : eels_array.shape[2]]
     xdata = (np.arange(eels_array.shape[0]) - eels_dict["pixelOrigin"][0]) * eels_dict[
         "pixelSize"
     ][0]
     peak_values = np.zeros(
-        (eels_array.shape[-2], eels_array.shape[-1], no_elements), dtype=np.float64
+        (eels_array.shape[-2], eels_array.shape[-1], no_elements), dtype=np.float32
     )
-    for ii in range(eels_array.shape[-2]):
-        for jj in range(eels_array.shape[-1]):
-            for qq in range(no_elements):
-                eels_data = eels_array[:, ii, jj]
-                fit_points = fit_range[qq, :]
-                peak_point = peak_range[qq, :]
-                lbi = ((yy - ii) ** 2) + ((xx - jj) ** 2) <= LBA_radius ** 2
-                eels_lbi = np.mean(eels_array[:, lbi], axis=-1)
-                bg, _, _ = powerlaw_fit(xdata, eels_lbi, fit_points)
-                subtracted_data = eels_data - bg
-                elemental_subtracted[:, ii, jj, qq] = subtracted_data
-                start_val = np.int(
-                    (peak_point[0] - np.amin(xdata)) / (np.median(np.diff(xdata)))
-                )
-                stop_val = np.int(
-                    (peak_point[1] - np.amin(xdata)) / (np.median(np.diff(xdata)))
-                )
-                peak_sum = np.sum(subtracted_data[start_val:stop_val])
-                peak_values[ii, jj, qq] = peak_sum
+    lba_size = int(LBA_radius)
+    lba_y, lba_x = np.mgrid[-lba_size : lba_size + 1, -lba_size : lba_size + 1]
+    lba_disk = np.asarray(
+        ((lba_y ** 2) + (lba_x ** 2)) <= (LBA_radius ** 2), dtype=np.float64
+    )
+    lba_count = scnd.correlate(
+        np.ones(eels_array.shape[1:], dtype=np.float64), lba_disk, mode="constant"
+    )
+    eels_lbi = (
+        scnd.correlate(
+            eels_array, lba_disk[np.newaxis, :, :], output=np.float64, mode="constant"
+        )
+        / lba_count
+    )
+    dx = np.median(np.diff(xdata))
+    peak_index = ((peak_range - np.amin(xdata)) / dx).astype(int)
+    for qq in range(no_elements):
+        fit_points = fit_range[qq, :]
+        start_val, stop_val = peak_index[qq, :]
+        bg, _, _ = powerlaw_fit(xdata, eels_lbi, fit_points, dx)
+        subtracted_data = eels_array - bg
+        elemental_subtracted[:, :, :, qq] = subtracted_data
+        peak_values[:, :, qq] = np.sum(subtracted_data[start_val:stop_val], axis=0)
     return peak_values, elemental_subtracted
 
 
@@ -203,7 +233,6 @@ def lcpl(xx, c1, p1, c2, p2):
     return yy
 
 
-@numba.jit
 def eels_3D_LCPL(eels_dict, fit_range, peak_range, LBA_radius=3, percentile=5):
     fit_range = np.asarray(fit_range)
     peak_range = np.asarray(peak_range)
@@ -226,14 +255,16 @@ def eels_3D_LCPL(eels_dict, fit_range, peak_range, LBA_radius=3, percentile=5):
     const_values = np.zeros(
         (eels_array.shape[-2], eels_array.shape[-1], no_elements), dtype=np.float32
     )
+    dx = np.median(np.diff(xdata))
+    fit_index = ((fit_range - np.amin(xdata)) / dx).astype(int)
+    peak_index = ((peak_range - np.amin(xdata)) / dx).astype(int)
 
     for ii in range(eels_array.shape[-2]):
         for jj in range(eels_array.shape[-1]):
             for kk in range(no_elements):
                 eels_data = eels_array[:, ii, jj]
                 fit_points = fit_range[kk, :]
-                peak_point = peak_range[kk, :]
-                _, power, const = powerlaw_fit(xdata, eels_data, fit_points)
+                _, power, const = powerlaw_fit(xdata, eels_data, fit_points, dx)
                 power_values[ii, jj, kk] = power
                 const_values[ii, jj, kk] = const
 
@@ -264,14 +295,7 @@ def eels_3D_LCPL(eels_dict, fit_range, peak_range, LBA_radius=3, percentile=5):
         for qq in range(eels_array.shape[-1]):
             for rr in range(no_elements):
                 eels_data = eels_array[:, pp, qq]
-                fit_points = fit_range[rr, :]
-                peak_point = peak_range[rr, :]
-                star_val = np.int(
-                    (fit_points[0] - np.amin(xdata)) / (np.median(np.diff(xdata)))
-                )
-                stop_val = np.int(
-                    (fit_points[1] - np.amin(xdata)) / (np.median(np.diff(xdata)))
-                )
+                star_val, stop_val = fit_index[rr, :]
 
                 lbi = (((yy - ii) ** 2) + ((xx - jj) ** 2)) <= (LBA_radius ** 2)
                 eels_lbi = np.mean(eels_array[:, lbi], axis=-1)
@@ -286,12 +310,7 @@ def eels_3D_LCPL(eels_dict, fit_range, peak_range, LBA_radius=3, percentile=5):
                 background = lcpl(xdata, popt[0], popt[1], popt[2], popt[3])
                 subtracted_data = eels_data - background
                 elemental_subtracted[:, pp, qq, rr] = subtracted_data
-                star_sum = np.int(
-                    (peak_point[0] - np.amin(xdata)) / (np.median(np.diff(xdata)))
-                )
-                stop_sum = np.int(
-                    (peak_point[1] - np.amin(xdata)) / (np.median(np.diff(xdata)))
-                )
+                star_sum, stop_sum = peak_index[rr, :]
                 peak_values[pp, qq, rr] = np.sum(subtracted_data[star_sum:stop_sum])
 
     return peak_values, elemental_subtracted
@@ -1,8 +1,8 @@
 import numpy as np
 import numba
 import warnings
+import concurrent.futures as cf
 import scipy.ndimage as scnd
-import scipy.optimize as sio
 import scipy.signal as scisig
 import skimage.feature as skfeat
 import matplotlib.colors as mplc
@@ -11,9 +11,7 @@ import stemtool as st
 import warnings
 
 
-def angle_fun(
-    angle, image_orig, axis=0,
-):
+def angle_fun(angle, image_orig, axis=0, order=5):
     """
     Rotation Sum Finder
     
@@ -25,6 +23,8 @@ def angle_fun(
                 Input Image
     axis:       int, optional
                 Axis along which to perform sum
+    order:      int, optional
+                Spline order of the rotation. Default is 5
                      
     Returns
     -------
@@ -41,7 +41,7 @@ def angle_fun(
     --------
     rotation_finder 
     """
-    rotated_image = scnd.rotate(image_orig, angle, order=5, reshape=False)
+    rotated_image = scnd.rotate(image_orig, angle, order=order, reshape=False)
     rotsum = (-1) * (np.sum(rotated_image, 1))
     rotmin = np.amin(rotsum)
     return rotmin
@@ -68,15 +68,41 @@ def rotation_finder(image_orig, axis=0):
     Notes
     -----
     Uses the `angle_fun` function as the minimizer.
+    The minimum is first bracketed on a 2 degree grid
+    from 0 to 180 degrees - which covers every angle 
+    as the sum repeats every 180 degrees - with cheap 
+    linear interpolation rotations, that are run in 
+    parallel threads. The grid minimum and its two 
+    neighbors are then recalculated with the default
+    5th order rotations, and the angle is refined to 
+    the vertex of the parabola through the three.
 
     See Also
     --------
     angle_fun
     """
-    x0 = 90
-    x = sio.minimize(angle_fun, x0, args=(image_orig))
-    min_x = x.x
-    return min_x
+    angle_step = 2.0
+    coarse_angles = np.arange(0, 180, angle_step)
+    with cf.ThreadPoolExecutor() as executor:
+        coarse_sums = np.asarray(
+            list(
+                executor.map(
+                    lambda angle: angle_fun(angle, image_orig, axis, 1), coarse_angles
+                )
+            )
+        )
+    grid_x = coarse_angles[np.argmin(coarse_sums)]
+    sum_left, sum_mid, sum_right = [
+        angle_fun(angle, image_orig, axis)
+        for angle in (grid_x - angle_step, grid_x, grid_x + angle_step)
+    ]
+    curvature = sum_left - (2 * sum_mid) + sum_right
+    if curvature > 0:
+        vertex_shift = 0.5 * (sum_left - sum_right) / curvature
+        min_x = grid_x + (angle_step * np.clip(vertex_shift, -1, 1))
+    else:
+        min_x = grid_x
+    return float(min_x)
 
 
 def rotate_and_center_ROI(data4D_ROI, rotangle, xcenter, ycenter):
@@ -106,21 +132,29 @@ def rotate_and_center_ROI(data4D_ROI, rotangle, xcenter, ycenter):
     -----
     We start by centering each 4D-STEM CBED pattern 
     and then rotating the patterns with respect to the
-    pattern center
+    pattern center. Both steps are combined into a single
+    affine transformation, so every pattern is interpolated
+    only once with a cubic spline, and the patterns are 
+    transformed in parallel threads.
     """
     data_size = np.asarray(np.shape(data4D_ROI))
     corrected_ROI = np.zeros_like(data4D_ROI)
-    for ii in range(data4D_ROI.shape[0]):
-        cbed_pattern = data4D_ROI[ii, :, :]
-        moved_cbed = np.abs(
-            st.util.move_by_phase(
-                cbed_pattern,
-                (-xcenter + (0.5 * data_size[-1])),
-                (-ycenter + (0.5 * data_size[-2])),
-            )
+    rot_cos = np.cos(np.deg2rad(rotangle))
+    rot_sin = np.sin(np.deg2rad(rotangle))
+    rot_matrix = np.asarray(((rot_cos, rot_sin), (-rot_sin, rot_cos)))
+    pattern_center = (data_size[-2:] - 1) / 2
+    pattern_shift = np.asarray(
+        ((-ycenter + (0.5 * data_size[-2])), (-xcenter + (0.5 * data_size[-1])))
+    )
+    rot_offset = pattern_center - np.matmul(rot_matrix, pattern_center) - pattern_shift
+
+    def correct_pattern(ii):
+        corrected_ROI[ii, :, :] = scnd.affine_transform(
+            data4D_ROI[ii, :, :], rot_matrix, offset=rot_offset, order=3
         )
-        rotated_cbed = scnd.rotate(moved_cbed, rotangle, order=5, reshape=False)
-        corrected_ROI[ii, :, :] = rotated_cbed
+
+    with cf.ThreadPoolExecutor() as executor:
+        list(executor.map(correct_pattern, range(data4D_ROI.shape[0])))
     return corrected_ROI
 
 
@@ -148,38 +182,6 @@ def data4Dto2D(data4D):
     return data2D
 
 
-@numba.jit(parallel=True, cache=True)
-def resizer1D_numbaopt(data, res, N):
-    M = data.size
-    carry = 0
-    m = 0
-    for n in range(int(N)):
-        data_sum = carry
-        while ((m * N) - (n * M)) < M:
-            data_sum += data[m]
-            m += 1
-        carry = (m - (n + 1) * (M / N)) * data[m - 1]
-        data_sum -= carry
-        res[n] = data_sum * (N / M)
-    return res
-
-
-@numba.jit(parallel=True, cache=True)
-def resizer2D_numbaopt(data2D, resampled_x, resampled_f, sampling):
-    data_shape = np.asarray(data2D.shape)
-    sampled_shape = (np.round(data_shape / sampling)).astype(int)
-    for yy in numba.prange(data_shape[0]):
-        resampled_x[yy, :] = resizer1D_numbaopt(
-            data2D[yy, :], resampled_x[yy, :], sampled_shape[1]
-        )
-    for xx in numba.prange(sampled_shape[1]):
-        resampled_f[:, xx] = resizer1D_numbaopt(
-            resampled_x[:, xx], resampled_f[:, xx], sampled_shape[0]
-        )
-    return resampled_f
-
-
-@numba.jit
 def bin4D(data4D, bin_factor):
     """
     Bin 4D data in spectral dimensions
@@ -201,32 +203,16 @@ def bin4D(data4D, bin_factor):
     Notes
     -----
     The data is binned in the first two dimensions - which are
-    the Fourier dimensions using the internal numba functions 
-    `resizer2D_numbaopt` and `resizer1D_numbaopt`
+    the Fourier dimensions using `resizer2D`, which resamples
+    every scan position at once.
 
     See Also
     --------
-    resizer1D_numbaopt
-    resizer2D_numbaopt
+    util.resizer
+    util.resizer2D
     """
-    data4D_flat = np.reshape(
-        data4D, (data4D.shape[0], data4D.shape[1], data4D.shape[2] * data4D.shape[3])
-    )
-    datashape = np.asarray(data4D_flat.shape)
-    res_shape = np.copy(datashape)
-    res_shape[0:2] = np.round(datashape[0:2] / bin_factor)
-    data4D_res = np.zeros(res_shape.astype(int), dtype=data4D_flat.dtype)
-    resampled_x = np.zeros((datashape[0], res_shape[1]), data4D_flat.dtype)
-    resampled_f = np.zeros(res_shape[0:2], dtype=data4D_flat.dtype)
-    for zz in range(data4D_flat.shape[-1]):
-        data4D_res[:, :, zz] = resizer2D_numbaopt(
-            data4D_flat[:, :, zz], resampled_x, resampled_f, bin_factor
-        )
-    binned_data = np.reshape(
-        data4D_res,
-        (resampled_f.shape[0], resampled_f.shape[1], data4D.shape[2], data4D.shape[3]),
-    )
-    return binned_data
+    binned_data = st.util.resizer2D(np.ascontiguousarray(data4D), bin_factor)
+    return binned_data.astype(data4D.dtype)
 
 
 def test_aperture(pattern, center, radius, showfig=True):
@@ -260,11 +246,10 @@ def test_aperture(pattern, center, radius, showfig=True):
     location with varying parameters
     """
     center = np.asarray(center)
-    yy, xx = np.mgrid[0 : pattern.shape[0], 0 : pattern.shape[1]]
-    yy = yy - center[1]
-    xx = xx - center[0]
-    rr = ((yy ** 2) + (xx ** 2)) ** 0.5
-    aperture = np.asarray(rr <= radius, dtype=np.double)
+    yy, xx = np.mgrid[0 : pattern.shape[0], 0 : pattern.shape[1]].astype(np.float64)
+    yy -= center[1]
+    xx -= center[0]
+    aperture = np.asarray(((yy ** 2) + (xx ** 2)) <= (radius ** 2), dtype=np.double)
     if showfig:
         plt.figure(figsize=(15, 15))
         plt.imshow(st.util.image_normalizer(pattern) + aperture, cmap="Spectral")
@@ -295,25 +280,26 @@ def aperture_image(data4D, center, radius):
     
     Notes
     -----
-    We generate the aperture first, and then make copies
-    of the aperture to generate a 4D dataset of the same 
-    size as the 4D data. Then we do an element wise 
-    multiplication of this aperture 4D data with the 4D data
-    and then sum it along the two Fourier directions.
+    We generate the aperture first, and then find the 
+    Fourier pixels that lie inside it. The real space 
+    images at only those Fourier pixels are then summed,
+    so neither a 4D copy of the aperture nor the products
+    with the zeros outside it are ever generated.
     """
     center = np.array(center)
-    yy, xx = np.mgrid[0 : data4D.shape[0], 0 : data4D.shape[1]]
-    yy = yy - center[1]
-    xx = xx - center[0]
-    rr = ((yy ** 2) + (xx ** 2)) ** 0.5
-    aperture = np.asarray(rr <= radius, dtype=data4D.dtype)
-    apt_copy = np.empty(
-        (data4D.shape[2], data4D.shape[3]) + aperture.shape, dtype=data4D.dtype
+    yy, xx = np.mgrid[0 : data4D.shape[0], 0 : data4D.shape[1]].astype(np.float64)
+    yy -= center[1]
+    xx -= center[0]
+    aperture = ((yy ** 2) + (xx ** 2)) <= (radius ** 2)
+    data4D = np.ascontiguousarray(data4D)
+    data_flat = np.reshape(
+        data4D, (data4D.shape[0] * data4D.shape[1], data4D.shape[2], data4D.shape[3])
+    )
+    df_image = np.sum(
+        data_flat[np.flatnonzero(aperture)],
+        axis=0,
+        dtype=np.result_type(data4D.dtype, np.float32),
     )
-    apt_copy[:] = aperture
-    apt_copy = np.transpose(apt_copy, (2, 3, 0, 1))
-    apt_mult = apt_copy * data4D
-    df_image = np.sum(np.sum(apt_mult, axis=0), axis=0)
     return df_image
 
 
@@ -341,11 +327,15 @@ def custom_detector(data4D, det_inner, det_outer, det_center=(0, 0), mrad_calib=
     
     Notes
     -----
-    We generate the aperture first, and then make copies
-    of the aperture to generate a 4D dataset of the same 
-    size as the 4D data. Then we do an element wise 
-    multiplication of this aperture 4D data with the 4D data
-    and then sum it along the two Fourier directions.
+    We generate the annular aperture first, and then find 
+    the Fourier pixels that lie inside it. The real space 
+    images at only those Fourier pixels are then summed,
+    the same way as in `aperture_image`, so no 4D copy of
+    the aperture is made.
+    
+    See Also
+    --------
+    aperture_image
     """
     if mrad_calib > 0:
         det_inner = det_inner * mrad_calib
@@ -353,19 +343,21 @@ def custom_detector(data4D, det_inner, det_outer, det_center=(0, 0), mrad_calib=
         det_center = np.asarray(det_center) * mrad_calib
     det_center = np.asarray(det_center)
     yy, xx = np.mgrid[0 : data4D.shape[0], 0 : data4D.shape[1]]
-    yy -= 0.5 * data4D.shape[0]
-    xx -= 0.5 * data4D.shape[1]
+    yy = yy - (0.5 * data4D.shape[0])
+    xx = xx - (0.5 * data4D.shape[1])
     yy = yy - det_center[1]
     xx = xx - det_center[0]
     rr = (yy ** 2) + (xx ** 2)
     aperture = np.logical_and((rr <= det_outer), (rr >= det_inner))
-    apt_copy = np.empty(
-        (data4D.shape[2], data4D.shape[3]) + aperture.shape, dtype=data4D.dtype
+    data4D = np.ascontiguousarray(data4D)
+    data_flat = np.reshape(
+        data4D, (data4D.shape[0] * data4D.shape[1], data4D.shape[2], data4D.shape[3])
+    )
+    df_image = np.sum(
+        data_flat[np.flatnonzero(aperture)],
+        axis=0,
+        dtype=np.result_type(data4D.dtype, np.float32),
     )
-    apt_copy[:] = aperture
-    apt_copy = np.transpose(apt_copy, (2, 3, 0, 1))
-    apt_mult = apt_copy * data4D
-    df_image = np.sum(np.sum(apt_mult, axis=0), axis=0)
     return df_image
 
 
@@ -382,28 +374,25 @@ def ROI_from_image(image, med_val, style="over", showfig=True):
     return ROI
 
 
-@numba.jit
 def colored_mcr(conc_data, data_shape):
     no_spectra = np.shape(conc_data)[1]
     color_hues = np.arange(no_spectra, dtype=np.float64) / no_spectra
     norm_conc = (conc_data - np.amin(conc_data)) / (
         np.amax(conc_data) - np.amin(conc_data)
     )
-    saturation_matrix = np.ones(data_shape, dtype=np.float64)
-    hsv_calc = np.zeros((data_shape[0], data_shape[1], 3), dtype=np.float64)
-    rgb_calc = np.zeros((data_shape[0], data_shape[1], 3), dtype=np.float64)
-    hsv_calc[:, :, 1] = saturation_matrix
-    for ii in range(no_spectra):
-        conc_image = (np.reshape(norm_conc[:, ii], data_shape)).astype(np.float64)
-        hsv_calc[:, :, 0] = saturation_matrix * color_hues[ii]
-        hsv_calc[:, :, 2] = conc_image
-        rgb_calc = rgb_calc + mplc.hsv_to_rgb(hsv_calc)
+    hsv_calc = np.ones((no_spectra, data_shape[0], data_shape[1], 3), dtype=np.float32)
+    hsv_calc[:, :, :, 0] = color_hues[:, np.newaxis, np.newaxis]
+    hsv_calc[:, :, :, 2] = np.reshape(
+        np.transpose(norm_conc), (no_spectra, data_shape[0], data_shape[1])
+    )
+    rgb_calc = np.sum(mplc.hsv_to_rgb(hsv_calc), axis=0)
     rgb_image = rgb_calc / np.amax(rgb_calc)
     return rgb_image
 
 
-@numba.jit
-def fit_nbed_disks(corr_image, disk_size, positions, diff_spots, nan_cutoff=0):
+def fit_nbed_disks(
+    corr_image, disk_size, positions, diff_spots, nan_cutoff=0, pinv=None, masks=None
+):
     """
     Disk Fitting algorithm for a single NBED pattern
     
@@ -424,6 +413,15 @@ def fit_nbed_disks(corr_image, disk_size, positions, diff_spots, nan_cutoff=0):
                 Optional parameter that is used for thresholding disk
                 fits. If the intensity ratio is below the threshold 
                 the position will not be fit. Default value is 0
+    pinv:       ndarray of shape (2,n), optional
+                Pseudo-inverse of diff_spots. If given, the axes
+                of patterns where every disk was fitted are found
+                by multiplying with it instead of a least squares 
+                solve every time. Default is None
+    masks:      list, optional
+                The `util.fitting_mask` of every disk position,
+                for an image of the size of corr_image. If None,
+                they are calculated here. Default is None
     
     Returns
     -------
@@ -447,24 +445,31 @@ def fit_nbed_disks(corr_image, disk_size, positions, diff_spots, nan_cutoff=0):
     zero then only the locations inside this cutoff where the maximum pixel intensity 
     is (1+nan_cutoff) times the median pixel intensity will be fitted. Use this 
     parameter carefully, because in some cases this may result in no disks being fitted
-    and the program throwing weird errors at you. 
+    and the program throwing weird errors at you. The circles are the same for every
+    pattern of a dataset, so calculate them once and pass them as masks.
     """
     warnings.filterwarnings("ignore")
     no_pos = int(np.shape(positions)[0])
     diff_spots = np.asarray(diff_spots, dtype=np.float64)
     fitted_disk_list = np.zeros_like(positions)
-    yy, xx = np.mgrid[0 : (corr_image.shape[0]), 0 : (corr_image.shape[1])]
+    if masks is None:
+        masks = [
+            st.util.fitting_mask(corr_image.shape, posx, posy, disk_size)
+            for posx, posy in positions[:, 0:2]
+        ]
     for ii in range(no_pos):
         posx = positions[ii, 0]
         posy = positions[ii, 1]
-        reg = ((yy - posy) ** 2) + ((xx - posx) ** 2) <= (disk_size ** 2)
+        reg = masks[ii][0]
         peak_ratio = np.amax(corr_image[reg]) / np.median(corr_image[reg])
         if peak_ratio < (1 + nan_cutoff):
             fitted_disk_list[ii, 0:2] = np.nan
         else:
-            par = st.util.fit_gaussian2D_mask(corr_image, posx, posy, disk_size)
+            par = st.util.fit_gaussian2D_mask(
+                corr_image, posx, posy, disk_size, mask=masks[ii]
+            )
             fitted_disk_list[ii, 0:2] = par[0:2]
-    nancount = np.int(np.sum(np.isnan(fitted_disk_list)) / 2)
+    nancount = int(np.sum(np.isnan(fitted_disk_list)) / 2)
     if nancount == no_pos:
         center_position = np.nan * np.ones((1, 2))
         fit_deviation = np.nan
@@ -489,7 +494,12 @@ def fit_nbed_disks(corr_image, disk_size, positions, diff_spots, nan_cutoff=0):
                 disk_locations[:, 0:2] = disk_locations[:, 0:2] - np.asarray(
                     (cx, cy), dtype=np.float64
                 )
-                lcbed, _, _, _ = np.linalg.lstsq(diff_spots, disk_locations, rcond=None)
+                if (pinv is None) or (nancount > 0):
+                    lcbed, _, _, _ = np.linalg.lstsq(
+                        diff_spots, disk_locations, rcond=None
+                    )
+                else:
+                    lcbed = np.matmul(pinv, disk_locations)
                 calc_points = np.matmul(diff_spots, lcbed)
                 stdx = np.std(
                     np.divide(
@@ -514,7 +524,6 @@ def fit_nbed_disks(corr_image, disk_size, positions, diff_spots, nan_cutoff=0):
     return fitted_disk_list, center_position, fit_deviation, lcbed
 
 
-@numba.jit
 def strain_in_ROI(
     data4D,
     ROI,
@@ -526,6 +535,7 @@ def strain_in_ROI(
     gauss_val=3,
     hybrid_cc=0.1,
     nan_cutoff=0.5,
+    batch_size=64,
 ):
     """
     Get strain from a region of interest
@@ -567,6 +577,9 @@ def strain_in_ROI(
                     Parameter that is used for thresholding disk
                     fits. If the intensity ratio is below the threshold 
                     the position will not be fit. Default value is 0.5    
+    batch_size:     int, optional
+                    Number of CBED patterns that are filtered and 
+                    cross-correlated together. Default is 64
     
     Returns
     -------
@@ -596,11 +609,17 @@ def strain_in_ROI(
     warnings.filterwarnings("ignore")
     # Calculate needed values
     scan_y, scan_x = np.mgrid[0 : data4D.shape[2], 0 : data4D.shape[3]]
-    data4D_ROI = data4D[:, :, scan_y[ROI], scan_x[ROI]]
-    no_of_disks = data4D_ROI.shape[-1]
+    data4D_ROI = np.ascontiguousarray(np.transpose(data4D[:, :, ROI], (2, 0, 1)))
+    no_of_disks = data4D_ROI.shape[0]
     disk_size = (np.sum(st.util.image_normalizer(center_disk)) / np.pi) ** 0.5
     i_matrix = (np.eye(2)).astype(np.float64)
     sobel_center_disk, _ = st.util.sobel(center_disk)
+    sobel_center_fft = st.util.cross_corr_fft(sobel_center_disk)
+    pos_pinv = np.linalg.pinv(np.asarray(pos_list, dtype=np.float64))
+    disk_masks = [
+        st.util.fitting_mask(data4D_ROI.shape[-2:], posx, posy, disk_size)
+        for posx, posy in disk_list[:, 0:2]
+    ]
     # Initialize matrices
     e_xx_ROI = np.nan * (np.ones(no_of_disks, dtype=np.float64))
     e_xy_ROI = np.nan * (np.ones(no_of_disks, dtype=np.float64))
@@ -614,43 +633,57 @@ def strain_in_ROI(
     # Calculate for mean CBED if no reference
     # axes present
     if np.size(reference_axes) < 2:
-        mean_cbed = np.mean(data4D_ROI, axis=-1)
-        sobel_lm_cbed, _ = st.util.sobel(st.util.image_logarizer(mean_cbed))
+        mean_cbed = np.mean(data4D_ROI, axis=0)
+        sobel_lm_cbed = st.util.log_sobel_magnitude(mean_cbed)
         sobel_lm_cbed[
             sobel_lm_cbed > med_factor * np.median(sobel_lm_cbed)
         ] = np.median(sobel_lm_cbed)
         lsc_mean = st.util.cross_corr(
-            sobel_lm_cbed, sobel_center_disk, hybridizer=hybrid_cc
+            sobel_lm_cbed,
+            sobel_center_disk,
+            hybridizer=hybrid_cc,
+            ref_fft=sobel_center_fft,
+        )
+        _, _, _, mean_axes = fit_nbed_disks(
+            lsc_mean,
+            disk_size,
+            disk_list,
+            pos_list,
+            pinv=pos_pinv,
+            masks=disk_masks,
         )
-        _, _, _, mean_axes = fit_nbed_disks(lsc_mean, disk_size, disk_list, pos_list)
         inverse_axes = np.linalg.inv(mean_axes)
     else:
         inverse_axes = np.linalg.inv(reference_axes)
-    for ii in range(int(no_of_disks)):
-        pattern = data4D_ROI[:, :, ii]
-        sobel_log_pattern, _ = st.util.sobel(
-            scnd.gaussian_filter(st.util.image_logarizer(pattern), gauss_val)
-        )
-        sobel_log_pattern[
-            sobel_log_pattern > med_factor * np.median(sobel_log_pattern)
-        ] = (np.median(sobel_log_pattern) * med_factor)
-        sobel_log_pattern[
-            sobel_log_pattern < np.median(sobel_log_pattern) / med_factor
-        ] = (np.median(sobel_log_pattern) / med_factor)
-        lsc_pattern = st.util.cross_corr(
-            sobel_log_pattern, sobel_center_disk, hybridizer=hybrid_cc
-        )
-        _, _, std, pattern_axes = fit_nbed_disks(
-            lsc_pattern, disk_size, disk_list, pos_list, nan_cutoff
+    # Filter and correlate the patterns in batches
+    # to keep the padded transforms small in memory
+    no_of_batches = max(1, int(np.ceil(no_of_disks / batch_size)))
+    for batch in np.array_split(np.arange(no_of_disks), no_of_batches):
+        sobel_log_batch = log_sobel3D(data4D_ROI[batch], med_factor, gauss_val)
+        lsc_batch = st.util.cross_corr(
+            sobel_log_batch,
+            sobel_center_disk,
+            hybridizer=hybrid_cc,
+            ref_fft=sobel_center_fft,
         )
-        if ~(np.isnan(np.ravel(pattern_axes))[0]):
-            fit_std[ii, :] = std
-            t_pattern = np.matmul(pattern_axes, inverse_axes)
-            s_pattern = t_pattern - i_matrix
-            e_xx_ROI[ii] = -s_pattern[0, 0]
-            e_xy_ROI[ii] = -(s_pattern[0, 1] + s_pattern[1, 0])
-            e_th_ROI[ii] = s_pattern[0, 1] - s_pattern[1, 0]
-            e_yy_ROI[ii] = -s_pattern[1, 1]
+        for ii, lsc_pattern in zip(batch, lsc_batch):
+            _, _, std, pattern_axes = fit_nbed_disks(
+                lsc_pattern,
+                disk_size,
+                disk_list,
+                pos_list,
+                nan_cutoff,
+                pos_pinv,
+                disk_masks,
+            )
+            if ~(np.isnan(np.ravel(pattern_axes))[0]):
+                fit_std[ii, :] = std
+                t_pattern = np.matmul(pattern_axes, inverse_axes)
+                s_pattern = t_pattern - i_matrix
+                e_xx_ROI[ii] = -s_pattern[0, 0]
+                e_xy_ROI[ii] = -(s_pattern[0, 1] + s_pattern[1, 0])
+                e_th_ROI[ii] = s_pattern[0, 1] - s_pattern[1, 0]
+                e_yy_ROI[ii] = -s_pattern[1, 1]
     e_xx_map[ROI] = e_xx_ROI
     e_xx_map[np.isnan(e_xx_map)] = 0
     e_xx_map = scnd.gaussian_filter(e_xx_map, 1)
@@ -666,7 +699,6 @@ def strain_in_ROI(
     return e_xx_map, e_xy_map, e_th_map, e_yy_map, fit_std
 
 
-@numba.jit
 def strain_log(
     data4D_ROI, center_disk, disk_list, pos_list, reference_axes=0, med_factor=10
 ):
@@ -706,8 +738,9 @@ def strain_log(
     return e_xx_log, e_xy_log, e_th_log, e_yy_log
 
 
-@numba.jit
-def strain_oldstyle(data4D_ROI, center_disk, disk_list, pos_list, reference_axes=0):
+def strain_oldstyle(
+    data4D_ROI, center_disk, disk_list, pos_list, reference_axes=0, batch_size=64
+):
     warnings.filterwarnings("ignore")
     # Calculate needed values
     no_of_disks = data4D_ROI.shape[-1]
@@ -720,23 +753,44 @@ def strain_oldstyle(data4D_ROI, center_disk, disk_list, pos_list, reference_axes
     e_yy_ROI = np.zeros(no_of_disks, dtype=np.float64)
     # Calculate for mean CBED if no reference
     # axes present
+    center_fft = st.util.cross_corr_fft(center_disk)
+    pos_pinv = np.linalg.pinv(np.asarray(pos_list, dtype=np.float64))
+    ROI_stack = np.ascontiguousarray(np.transpose(data4D_ROI, (2, 0, 1)))
+    disk_masks = [
+        st.util.fitting_mask(ROI_stack.shape[-2:], posx, posy, disk_size)
+        for posx, posy in disk_list[:, 0:2]
+    ]
     if np.size(reference_axes) < 2:
-        mean_cbed = np.mean(data4D_ROI, axis=-1)
-        cc_mean = st.util.cross_corr(mean_cbed, center_disk, hybridizer=0.1)
-        _, _, mean_axes = fit_nbed_disks(cc_mean, disk_size, disk_list, pos_list)
+        mean_cbed = np.mean(ROI_stack, axis=0)
+        cc_mean = st.util.cross_corr(
+            mean_cbed, center_disk, hybridizer=0.1, ref_fft=center_fft
+        )
+        _, _, _, mean_axes = fit_nbed_disks(
+            cc_mean, disk_size, disk_list, pos_list, pinv=pos_pinv, masks=disk_masks
+        )
         inverse_axes = np.linalg.inv(mean_axes)
     else:
         inverse_axes = np.linalg.inv(reference_axes)
-    for ii in range(int(no_of_disks)):
-        pattern = data4D_ROI[:, :, ii]
-        cc_pattern = st.util.cross_corr(pattern, center_disk, hybridizer=0.1)
-        _, _, pattern_axes = fit_nbed_disks(cc_pattern, disk_size, disk_list, pos_list)
-        t_pattern = np.matmul(pattern_axes, inverse_axes)
-        s_pattern = t_pattern - i_matrix
-        e_xx_ROI[ii] = -s_pattern[0, 0]
-        e_xy_ROI[ii] = -(s_pattern[0, 1] + s_pattern[1, 0])
-        e_th_ROI[ii] = s_pattern[0, 1] - s_pattern[1, 0]
-        e_yy_ROI[ii] = -s_pattern[1, 1]
+    no_of_batches = max(1, int(np.ceil(no_of_disks / batch_size)))
+    for batch in np.array_split(np.arange(no_of_disks), no_of_batches):
+        cc_batch = st.util.cross_corr(
+            ROI_stack[batch], center_disk, hybridizer=0.1, ref_fft=center_fft
+        )
+        for ii, cc_pattern in zip(batch, cc_batch):
+            _, _, _, pattern_axes = fit_nbed_disks(
+                cc_pattern,
+                disk_size,
+                disk_list,
+                pos_list,
+                pinv=pos_pinv,
+                masks=disk_masks,
+            )
+            t_pattern = np.matmul(pattern_axes, inverse_axes)
+            s_pattern = t_pattern - i_matrix
+            e_xx_ROI[ii] = -s_pattern[0, 0]
+            e_xy_ROI[ii] = -(s_pattern[0, 1] + s_pattern[1, 0])
+            e_th_ROI[ii] = s_pattern[0, 1] - s_pattern[1, 0]
+            e_yy_ROI[ii] = -s_pattern[1, 1]
     return e_xx_ROI, e_xy_ROI, e_th_ROI, e_yy_ROI
 
 
@@ -744,13 +798,67 @@ def ROI_strain_map(strain_ROI, ROI):
     """
     Convert the strain in the ROI array to a strain map
     """
-    strain_map = np.zeros_like(ROI, dtype=np.float64)
-    strain_map[ROI] = (strain_ROI).astype(np.float64)
+    strain_ROI = np.asarray(strain_ROI)
+    strain_map = np.zeros(np.shape(ROI), dtype=strain_ROI.dtype)
+    strain_map[ROI] = strain_ROI
     return strain_map
 
 
-@numba.jit(cache=True, parallel=True)
-def log_sobel4D(data4D, scan_dims, med_factor=30, gauss_val=3):
+def log_sobel3D(data3D, med_factor=30, gauss_val=3, sobel_order=3):
+    """
+    Take the Log-Sobel of a stack of patterns.
+    
+    Parameters
+    ----------
+    data3D:      ndarray 
+                 Stack of CBED patterns, where the first dimension 
+                 is the pattern number and the next two dimensions 
+                 are the diffraction dimensions
+    med_factor:  float, optional
+                 Due to detector noise, some stray pixels may often 
+                 be brighter than the background. This is used for 
+                 damping any such pixels. Default is 30
+    gauss_val:   float, optional
+                 The standard deviation of the Gaussian filter applied 
+                 to the logarithm of the CBED pattern. Default is 3
+    sobel_order: int, optional
+                 Size of the Sobel filter, 3 or 5. Default is 3
+    
+    Returns
+    -------
+    data_lsb: ndarray
+              Stack where each CBED pattern has been log
+              Sobel filtered
+    
+    Notes
+    -----
+    This is the same filter as `dpc.log_sobel` - the normalized 
+    log of each pattern is Gaussian blurred and Sobel filtered, 
+    and the Sobel spikes are then damped with respect to the 
+    median of that pattern. Every step works on the whole stack 
+    at once, with the normalization and the medians calculated 
+    pattern by pattern, so there is no loop over the patterns.
+    
+    See Also
+    --------
+    dpc.log_sobel
+    log_sobel4D
+    """
+    data_min = np.amin(data3D, axis=(-2, -1), keepdims=True)
+    data_max = np.amax(data3D, axis=(-2, -1), keepdims=True)
+    data_norm = (data3D - data_min) / (data_max - data_min)
+    data_log = np.log2(1 + (((2 ** 64) - 1) * data_norm))
+    data_lsb, _ = st.util.sobel(
+        scnd.gaussian_filter(data_log, (0, gauss_val, gauss_val)), sobel_order
+    )
+    data_med = np.median(data_lsb, axis=(-2, -1), keepdims=True)
+    data_lsb = np.minimum(data_lsb, data_med * med_factor)
+    data_med = np.median(data_lsb, axis=(-2, -1), keepdims=True)
+    data_lsb = np.maximum(data_lsb, data_med / med_factor)
+    return data_lsb
+
+
+def log_sobel4D(data4D, scan_dims, med_factor=30, gauss_val=3, batch_size=64):
     """
     Take the Log-Sobel of a pattern. 
     
@@ -769,6 +877,9 @@ def log_sobel4D(data4D, scan_dims, med_factor=30, gauss_val=3):
     gauss_val:  float, optional
                 The standard deviation of the Gaussian filter applied 
                 to the logarithm of the CBED pattern. Default is 3
+    batch_size: int, optional
+                Number of CBED patterns in each batch that is 
+                filtered in a thread. Default is 64
     
     Returns
     -------
@@ -787,34 +898,40 @@ def log_sobel4D(data4D, scan_dims, med_factor=30, gauss_val=3):
     images often are very noisy. This code generates the filtered
     CBED at every scan position, and is dimension agnostic, in
     that your CBED dimensions can either be the first two or last
-    two - just specify the dimensions. Also if loops weirdly need
-    to be outside the for loops - this is a numba feature (bug?)
+    two - just specify the dimensions. The CBED patterns are
+    stacked and filtered in batches with `log_sobel3D`, with the
+    batches running in parallel threads.
     Small change - made the Sobel matrix order 5 rather than 3
     
     See Also
     --------
     dpc.log_sobel
+    log_sobel3D
     """
     scan_dims = np.asarray(scan_dims)
     scan_dims[scan_dims < 0] = 4 + scan_dims[scan_dims < 0]
     sum_dims = np.sum(scan_dims)
     if sum_dims < 2:
         data4D = np.transpose(data4D, (2, 3, 0, 1))
-    data_lsb = np.zeros_like(data4D, dtype=np.float)
-    for jj in numba.prange(data4D.shape[int(scan_dims[1])]):
-        for ii in range(data4D.shape[int(scan_dims[0])]):
-            pattern = data4D[:, :, ii, jj]
-            pattern = 1000 * (1 + st.util.image_normalizer(pattern))
-            lsb_pattern, _ = st.util.sobel(
-                scnd.gaussian_filter(st.util.image_logarizer(pattern), gauss_val), 5
-            )
-            lsb_pattern[lsb_pattern > med_factor * np.median(lsb_pattern)] = (
-                np.median(lsb_pattern) * med_factor
-            )
-            lsb_pattern[lsb_pattern < np.median(lsb_pattern) / med_factor] = (
-                np.median(lsb_pattern) / med_factor
-            )
-            data_lsb[:, :, ii, jj] = lsb_pattern
+    data_shape = data4D.shape
+    data_stack = np.ascontiguousarray(
+        np.reshape(
+            np.transpose(data4D, (2, 3, 0, 1)), (-1, data_shape[0], data_shape[1])
+        )
+    )
+    no_of_batches = max(1, int(np.ceil(data_stack.shape[0] / batch_size)))
+    with cf.ThreadPoolExecutor() as executor:
+        lsb_batches = executor.map(
+            lambda batch: log_sobel3D(batch, med_factor, gauss_val, 5),
+            np.array_split(data_stack, no_of_batches),
+        )
+        data_lsb = np.concatenate(list(lsb_batches))
+    data_lsb = np.transpose(
+        np.reshape(
+            data_lsb, (data_shape[2], data_shape[3], data_shape[0], data_shape[1])
+        ),
+        (2, 3, 0, 1),
+    )
     if sum_dims < 2:
         data_lsb = np.transpose(data_lsb, (2, 3, 0, 1))
     return data_lsb
@@ -935,7 +1052,7 @@ def get_inside(edges, cutoff=0.95):
 
 
 def sobel_filter(image, med_filter=50):
-    ls_image, _ = st.util.sobel(st.util.image_logarizer(image))
+    ls_image = st.util.log_sobel_magnitude(image)
     ls_image[ls_image > (med_filter * np.median(ls_image))] = med_filter * np.median(
         ls_image
     )
@@ -945,7 +1062,6 @@ def sobel_filter(image, med_filter=50):
     return ls_image
 
 
-@numba.jit
 def strain4D_general(
     data4D,
     disk_radius,
@@ -1037,7 +1153,7 @@ def strain4D_general(
         imROI = ROI
     ROI_4D = data4D[:, :, imROI]
     no_of_disks = ROI_4D.shape[-1]
-    LSB_ROI = np.zeros_like(ROI_4D, dtype=np.float)
+    LSB_ROI = np.zeros_like(ROI_4D, dtype=np.float64)
     for ii in range(no_of_disks):
         cbed = ROI_4D[:, :, ii]
         cbed = 1000 * (1 + st.util.image_normalizer(cbed))
@@ -1053,14 +1169,12 @@ def strain4D_general(
         LSB_ROI[:, :, ii] = lsb_cbed
     Mean_LSB = np.median(LSB_ROI, axis=(-1))
     LSB_CC = st.util.cross_corr(Mean_LSB, sobel_disk, hybrid_cc)
-    data_peaks = skfeat.peak_local_max(
-        LSB_CC, min_distance=int(2 * disk_radius), indices=False
-    )
-    peak_labels = scnd.measurements.label(data_peaks)[0]
+    peak_coords = skfeat.peak_local_max(LSB_CC, min_distance=int(2 * disk_radius))
+    data_peaks = np.zeros_like(LSB_CC, dtype=bool)
+    data_peaks[tuple(np.transpose(peak_coords))] = True
+    peak_labels = scnd.label(data_peaks)[0]
     merged_peaks = np.asarray(
-        scnd.measurements.center_of_mass(
-            data_peaks, peak_labels, range(1, np.max(peak_labels) + 1)
-        )
+        scnd.center_of_mass(data_peaks, peak_labels, range(1, np.max(peak_labels) + 1))
     )
     fitted_mean = np.zeros_like(merged_peaks, dtype=np.float64)
     fitted_scan = np.zeros_like(merged_peaks, dtype=np.float64)
@@ -1077,10 +1191,6 @@ def strain4D_general(
         - fitted_mean[distarr == np.amin(distarr), :]
     )
     list_pos = np.zeros((int(np.sum(imROI)), peaks_mean.shape[0], peaks_mean.shape[1]))
-    exx_ROI = np.ones(no_of_disks, dtype=np.float64)
-    exy_ROI = np.ones(no_of_disks, dtype=np.float64)
-    eth_ROI = np.ones(no_of_disks, dtype=np.float64)
-    eyy_ROI = np.ones(no_of_disks, dtype=np.float64)
     for kk in range(no_of_disks):
         scan_LSB = LSB_ROI[:, :, kk]
         scan_CC = st.util.cross_corr(scan_LSB, sobel_disk, hybrid_cc)
@@ -1094,13 +1204,15 @@ def strain4D_general(
             - fitted_scan[distarr == np.amin(distarr), :]
         )
         list_pos[kk, :, :] = peaks_scan
-        scan_strain, _, _, _ = np.linalg.lstsq(peaks_mean, peaks_scan, rcond=None)
-        scan_strain = np.matmul(scan_strain, rotmatrix)
-        scan_strain = scan_strain - np.eye(2)
-        exx_ROI[kk] = scan_strain[0, 0]
-        exy_ROI[kk] = (scan_strain[0, 1] + scan_strain[1, 0]) / 2
-        eth_ROI[kk] = (scan_strain[0, 1] - scan_strain[1, 0]) / 2
-        eyy_ROI[kk] = scan_strain[1, 1]
+    # The least squares solution for every scan position
+    # with the same mean peaks is one stacked product
+    scan_strain = np.matmul(np.linalg.pinv(peaks_mean), list_pos)
+    scan_strain = np.matmul(scan_strain, rotmatrix)
+    scan_strain = scan_strain - np.eye(2)
+    exx_ROI = scan_strain[:, 0, 0]
+    exy_ROI = (scan_strain[:, 0, 1] + scan_strain[:, 1, 0]) / 2
+    eth_ROI = (scan_strain[:, 0, 1] - scan_strain[:, 1, 0]) / 2
+    eyy_ROI = scan_strain[:, 1, 1]
     e_xx_map[imROI] = exx_ROI
     e_xx_map[np.isnan(e_xx_map)] = 0
     e_xx_map = scnd.gaussian_filter(e_xx_map, 1)
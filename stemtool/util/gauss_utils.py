@@ -179,8 +179,70 @@ def initialize_gauss2D(xx, yy, zz, center_type="COM"):
     return gauss_ini
 
 
+def fitting_mask(image_shape, mask_x, mask_y, mask_radius, mask_type="circular"):
+    """
+    Pixels of an image that are inside a fitting mask
+    
+    Parameters
+    ----------
+    image_shape: tuple
+                 Shape of the image that will be masked
+    mask_x:      float
+                 x center of the mask
+    mask_y:      float
+                 y center of the mask
+    mask_radius: float
+                 The size of the mask. For a circulat mask this
+                 refers to the mask radius, while for a square mask
+                 this refers to half the side of the square
+    mask_type:   str
+                 Default is `circular`, while the other option is `square`
+    
+    Returns
+    -------
+    sub:   ndarray of dtype bool
+           The mask, of shape image_shape
+    x_pos: ndarray
+           x positions of the pixels inside the mask
+    y_pos: ndarray
+           y positions of the pixels inside the mask
+    
+    Notes
+    -----
+    When many images of the same size are fitted at the 
+    same starting positions - like the disks of every 
+    pattern in a 4D dataset - calculate the masks once 
+    with this and pass them to `fit_gaussian2D_mask`.
+    
+    See also
+    --------
+    fit_gaussian2D_mask
+    
+    :Authors:
+    Debangshu Mukherjee <mukherjeed@ornl.gov>
+    """
+    yV, xV = np.mgrid[0 : image_shape[0], 0 : image_shape[1]]
+    if mask_type == "circular":
+        sub = (((yV - mask_y) ** 2) + ((xV - mask_x) ** 2)) < (mask_radius ** 2)
+    elif mask_type == "square":
+        sub = np.logical_and(
+            (np.abs(yV - mask_y) < mask_radius), (np.abs(xV - mask_x) < mask_radius)
+        )
+    else:
+        raise ValueError("Unknown Mask Type")
+    x_pos = np.asarray(xV[sub], dtype=np.float64)
+    y_pos = np.asarray(yV[sub], dtype=np.float64)
+    return sub, x_pos, y_pos
+
+
 def fit_gaussian2D_mask(
-    image_data, mask_x, mask_y, mask_radius, mask_type="circular", center_type="COM"
+    image_data,
+    mask_x,
+    mask_y,
+    mask_radius,
+    mask_type="circular",
+    center_type="COM",
+    mask=None,
 ):
     """
     Fit a 2D gaussian to a masked image based on
@@ -205,6 +267,10 @@ def fit_gaussian2D_mask(
                  Center location for the first pass of the Gaussian.
                  Default is `COM`, while the other options are `minima`
                  or `maxima`.
+    mask:        tuple, optional
+                 The output of `fitting_mask` for this image size 
+                 and mask. If None, it is calculated here. Pass it 
+                 when fitting many images with the same mask.
     
     Returns
     -------
@@ -224,22 +290,16 @@ def fit_gaussian2D_mask(
     --------
     gaussian_2D_function
     initialize_gauss2D
+    fitting_mask
     
     :Authors:
     Debangshu Mukherjee <mukherjeed@ornl.gov>
     """
-    p, q = np.shape(image_data)
-    yV, xV = np.mgrid[0:p, 0:q]
-    if mask_type == "circular":
-        sub = ((((yV - mask_y) ** 2) + ((xV - mask_x) ** 2)) ** 0.5) < mask_radius
-    elif mask_type == "square":
-        sub = np.logical_and(
-            (np.abs(yV - mask_y) < mask_radius), (np.abs(xV - mask_x) < mask_radius)
+    if mask is None:
+        mask = fitting_mask(
+            np.shape(image_data), mask_x, mask_y, mask_radius, mask_type
         )
-    else:
-        raise ValueError("Unknown Mask Type")
-    x_pos = np.asarray(xV[sub], dtype=np.float64)
-    y_pos = np.asarray(yV[sub], dtype=np.float64)
+    sub, x_pos, y_pos = mask
     masked_image = np.asarray(image_data[sub], dtype=np.float64)
     mi_min = np.amin(masked_image)
     mi_max = np.amax(masked_image)
@@ -9,6 +9,7 @@ import scipy.misc as scm
 import scipy.optimize as spo
 import scipy.ndimage as scnd
 import scipy.signal as scsig
+import pyfftw.interfaces as pfi
 import skimage.color as skc
 import stemtool as st
 
@@ -247,7 +248,7 @@ def hsv_overlay(data, image, color, climit=None, bit_depth=8):
     return rgb_image
 
 
-def sparse_division(sparse_numer, sparse_denom, bit_depth=32):
+def sparse_division(sparse_numer, sparse_denom, bit_depth=32, axes=None):
     """
     Divide two sparse matrices element wise to prevent zeros
     
@@ -260,6 +261,11 @@ def sparse_division(sparse_numer, sparse_denom, bit_depth=32):
     bit_depth: int
                Bit depth of output image
                Default is 32
+    axes: tuple, optional
+          Axes over which the threshold maxima are 
+          calculated. Default is None, which uses the
+          whole array. Passing the image axes of a stack
+          thresholds every image separately
                      
     Returns
     -------
@@ -284,8 +290,8 @@ def sparse_division(sparse_numer, sparse_denom, bit_depth=32):
     depth_ratio = 2 ** bit_depth
     denom_abs = np.abs(sparse_denom)
     numer_abs = np.abs(sparse_numer)
-    threshold_denom = (np.amax(denom_abs)) / depth_ratio
-    threshold_numer = (np.amax(numer_abs)) / depth_ratio
+    threshold_denom = (np.amax(denom_abs, axis=axes, keepdims=True)) / depth_ratio
+    threshold_numer = (np.amax(numer_abs, axis=axes, keepdims=True)) / depth_ratio
     threshold_ind_denom = denom_abs < threshold_denom
     threshold_ind_numer = numer_abs < threshold_numer
     sparse_denom[threshold_ind_denom] = 1
@@ -309,7 +315,65 @@ def cross_corr_unpadded(image_1, image_2, normal=True):
     return corr_fft
 
 
-def cross_corr(image_1, image_2, hybridizer=0, normal=True):
+def cross_corr_fft(image, normal=True):
+    """
+    Padded Fourier transform for cross-correlation
+    
+    Parameters
+    ----------
+    image:  ndarray
+            Image to be transformed. If there are more
+            than two dimensions, the last two are the
+            image dimensions
+    normal: bool, optional
+            If True the image is first normalized by
+            its L2 norm. Default is True
+    
+    Returns
+    -------
+    image_fft: ndarray
+               Real Fourier transform of the padded image
+    
+    Notes
+    -----
+    The image is padded by half its size on each side 
+    with the median values before the Fourier transform,
+    which is exactly how `cross_corr` prepares both of 
+    its images. When a single template is correlated 
+    with many images, calculate its transform once with
+    this and pass it to `cross_corr` as `ref_fft`. Since
+    the images are real, only the non-negative frequency
+    half of the last axis is calculated, and stacks of 
+    images are transformed in a single multithreaded call.
+    The transform is done in single precision, which is 
+    ample for locating correlation peaks and halves the
+    memory traffic of the FFTs. The FFTs are done with
+    pyfftw, with its cache enabled, so repeated calls 
+    with the same image size reuse the FFTW plans.
+    
+    See Also
+    --------
+    cross_corr
+    
+    :Authors:
+    Debangshu Mukherjee <mukherjeed@ornl.gov>
+    """
+    im_size = np.asarray(np.shape(image))[-2:]
+    pad_size = (np.round(im_size / 2)).astype(int)
+    pad_width = ((0, 0),) * (np.ndim(image) - 2) + (
+        (pad_size[0], pad_size[0]),
+        (pad_size[1], pad_size[1]),
+    )
+    image = np.asarray(image, dtype=np.float32)
+    if normal:
+        image = image / (np.sum(image ** 2, axis=(-2, -1), keepdims=True) ** 0.5)
+    image_pad = np.pad(image, pad_width=pad_width, mode="median")
+    pfi.cache.enable()
+    image_fft = pfi.scipy_fft.rfft2(image_pad, workers=-1)
+    return image_fft
+
+
+def cross_corr(image_1, image_2, hybridizer=0, normal=True, ref_fft=None):
     """
     Normalized Correlation, allowing for hybridization 
     with cross correlation being the default output if
@@ -318,13 +382,24 @@ def cross_corr(image_1, image_2, hybridizer=0, normal=True):
     Parameters
     ----------
     image_1: ndarray
-             First image
+             First image. This can also be a stack of
+             images with the image dimensions last, 
+             which are all correlated with image_2
     image_2: ndarray
              Second image
     hybridizer: float
                 Hybridization parameter between 0 and 1
                 0 is pure cross correlation
                 1 is pure phase correlation
+    normal:     bool, optional
+                Normalize the images before correlating.
+                Default is True
+    ref_fft:    ndarray, optional
+                The `cross_corr_fft` of image_2, calculated 
+                with the same `normal`. If given, image_2 
+                is not transformed again, which saves one
+                FFT per call when the same image_2 is used
+                repeatedly
     
     Returns
     -------
@@ -362,31 +437,28 @@ def cross_corr(image_1, image_2, hybridizer=0, normal=True):
     See Also
     --------
     sparse_division
+    cross_corr_fft
     
     :Authors:
     Debangshu Mukherjee <mukherjeed@ornl.gov>
     """
-    im_size = np.asarray(np.shape(image_1))
+    im_size = np.asarray(np.shape(image_1))[-2:]
     pad_size = (np.round(im_size / 2)).astype(int)
-    if normal:
-        im1_norm = image_1 / (np.sum(image_1 ** 2) ** 0.5)
-        im1_pad = np.pad(im1_norm, pad_width=pad_size, mode="median")
-        im2_norm = image_2 / (np.sum(image_2 ** 2) ** 0.5)
-        im2_pad = np.pad(im2_norm, pad_width=pad_size, mode="median")
-        im1_fft = np.fft.fft2(im1_pad)
-        im2_fft = np.conj(np.fft.fft2(im2_pad))
-    else:
-        im1_pad = np.pad(image_1, pad_width=pad_size, mode="median")
-        im2_pad = np.pad(image_2, pad_width=pad_size, mode="median")
-        im1_fft = np.fft.fft2(im1_pad)
-        im2_fft = np.conj(np.fft.fft2(im2_pad))
+    if ref_fft is None:
+        ref_fft = cross_corr_fft(image_2, normal)
+    im1_fft = cross_corr_fft(image_1, normal)
+    im2_fft = np.conj(ref_fft)
     corr_fft = np.multiply(im1_fft, im2_fft)
     corr_abs = (np.abs(corr_fft)) ** hybridizer
-    corr_hybrid_fft = sparse_division(corr_fft, corr_abs, 32)
-    corr_hybrid = np.fft.ifft2(corr_hybrid_fft)
-    corr_hybrid = np.abs(np.fft.ifftshift(corr_hybrid))
+    corr_hybrid_fft = sparse_division(corr_fft, corr_abs, 32, axes=(-2, -1))
+    corr_hybrid = pfi.scipy_fft.irfft2(
+        corr_hybrid_fft, s=tuple(im_size + (2 * pad_size)), workers=-1
+    )
+    corr_hybrid = np.abs(np.fft.ifftshift(corr_hybrid, axes=(-2, -1)))
     corr_unpadded = corr_hybrid[
-        pad_size[0] : pad_size[0] + im_size[0], pad_size[1] : pad_size[1] + im_size[1]
+        ...,
+        pad_size[0] : pad_size[0] + im_size[0],
+        pad_size[1] : pad_size[1] + im_size[1],
     ]
     return corr_unpadded
 
@@ -547,8 +619,7 @@ def fit_circle(image_data, med_factor=50):
     return popt
 
 
-@numba.jit
-def resizer(data, N):
+def resizer(data, N, axis=-1):
     """
     Downsample 1D array
     
@@ -557,6 +628,9 @@ def resizer(data, N):
     data: ndarray
     N:    int
           New size of array
+    axis: int, optional
+          Axis along which to resample. Default
+          is the last axis
                      
     Returns
     -------
@@ -565,31 +639,42 @@ def resizer(data, N):
     
     Notes
     -----
-    The data is resampled. Since this is a Numba
-    function, compile it once (you will get errors)
-    by calling %timeit
+    The data is resampled by area averaging. The input
+    axis of size M is divided into N equal intervals, 
+    and every output value is the mean of the data over 
+    its interval, with the pixels cut by the interval 
+    edges contributing fractionally. The whole pixels 
+    are summed with `np.add.reduceat`, after which the 
+    fractional edge contributions are added in, so every
+    other axis of the data is resampled in the same pass.
+    Integer detector data is resampled in single precision,
+    while double precision data stays in double precision.
                  
     :Authors:
     Debangshu Mukherjee <mukherjeed@ornl.gov>
     """
-    warnings.filterwarnings("ignore")
-    M = data.size
-    data = (data).astype(np.float64)
-    res = np.zeros(int(N), dtype=np.float64)
-    carry = 0
-    m = 0
-    for n in range(int(N)):
-        data_sum = carry
-        while m * N - n * M < M:
-            data_sum += data[m]
-            m += 1
-        carry = (m - (n + 1) * M / N) * data[m - 1]
-        data_sum -= carry
-        res[n] = data_sum * N / M
-    return res
+    data = np.asarray(data)
+    data = np.moveaxis(
+        np.asarray(data, dtype=np.result_type(data.dtype, np.float32)), axis, 0
+    )
+    M = data.shape[0]
+    N = int(N)
+    edge_pos = np.arange(N + 1) * M
+    edge_index = edge_pos // N
+    edge_frac = ((edge_pos % N) / N).astype(data.dtype)
+    edge_frac = np.reshape(edge_frac, (-1,) + ((1,) * (data.ndim - 1)))
+    edge_data = data[np.minimum(edge_index, M - 1)]
+    whole_sum = np.add.reduceat(data, edge_index[:-1], axis=0)
+    empty_bins = edge_index[1:] == edge_index[:-1]
+    whole_sum[empty_bins] = 0
+    res = (
+        whole_sum
+        + (edge_frac[1:] * edge_data[1:])
+        - (edge_frac[:-1] * edge_data[:-1])
+    ) * (N / M)
+    return np.moveaxis(res, 0, axis)
 
 
-@numba.jit
 def resizer2D(data, sampling):
     """
     Downsample 2D array
@@ -609,7 +694,10 @@ def resizer2D(data, sampling):
     
     Notes
     -----
-    The data is a 2D wrapper over the resizer function
+    The data is a 2D wrapper over the resizer function,
+    resampling the first two axes. Any further axes are
+    carried along, so a stack of images with the image
+    dimensions first is resampled in one call.
     
     See Also
     --------
@@ -618,16 +706,11 @@ def resizer2D(data, sampling):
     :Authors:
     Debangshu Mukherjee <mukherjeed@ornl.gov>
     """
-    warnings.filterwarnings("ignore")
     sampling = np.asarray(sampling)
-    data_shape = np.asarray(np.shape(data))
+    data_shape = np.asarray(np.shape(data))[0:2]
     sampled_shape = (np.round(data_shape / sampling)).astype(int)
-    resampled_x = np.zeros((data_shape[0], sampled_shape[1]), dtype=np.float64)
-    resampled = np.zeros(sampled_shape, dtype=np.float64)
-    for yy in range(int(data_shape[0])):
-        resampled_x[yy, :] = resizer(data[yy, :], sampled_shape[1])
-    for xx in range(int(sampled_shape[1])):
-        resampled[:, xx] = resizer(resampled_x[:, xx], sampled_shape[0])
+    resampled_x = resizer(data, sampled_shape[1], axis=1)
+    resampled = resizer(resampled_x, sampled_shape[0], axis=0)
     return resampled
 
 
@@ -1,7 +1,6 @@
 import numpy as np
 import numba
 import warnings
-import scipy.signal as scisig
 import scipy.ndimage as scnd
 import stemtool as st
 import math
@@ -14,7 +13,10 @@ def sobel(im, order=3):
     Parameters
     ----------
     im:    ndarray
-           the original input image to be filtered
+           the original input image to be filtered.
+           If more than two dimensions are present,
+           the last two are the image dimensions and
+           every image is filtered separately
     order: int
            3 is the default but if 5 is specified
            then a 5x5 Sobel filter is run
@@ -30,10 +32,10 @@ def sobel(im, order=3):
     -----
     We define the two differentiation matrices - g_x and g_y
     and then move along our dataset - to perform the matrix 
-    operations on 5x5 or 3x3 sections of the input image. The 
-    magnitude of the Sobel filtered image is the absolute 
-    of the multiplied matrices - squared and summed and square
-    rooted.
+    operations on 5x5 or 3x3 sections of the input image, with
+    the image edges symmetrically reflected. The magnitude of 
+    the Sobel filtered image is the absolute of the multiplied 
+    matrices - squared and summed and square rooted.
     
     References
     ----------
@@ -67,13 +69,120 @@ def sobel(im, order=3):
             ),
             dtype=np.float64,
         )
-    g_x = scisig.convolve2d(im, k_x, mode="same", boundary="symm", fillvalue=0)
-    g_y = scisig.convolve2d(im, k_y, mode="same", boundary="symm", fillvalue=0)
+    stack_dims = (1,) * (im.ndim - 2)
+    k_x = np.reshape(k_x, stack_dims + k_x.shape)
+    k_y = np.reshape(k_y, stack_dims + k_y.shape)
+    g_x = scnd.convolve(im, k_x, mode="reflect")
+    g_y = scnd.convolve(im, k_y, mode="reflect")
     mag = ((g_x ** 2) + (g_y ** 2)) ** 0.5
     ang = np.arctan2(g_y, g_x)
     return mag, ang
 
 
+def log_sobel_magnitude(image, bit_depth=64):
+    """
+    Sobel magnitude of the normalized log of an image
+    
+    Parameters
+    ----------
+    image:     ndarray
+               the original input image to be filtered
+    bit_depth: int, optional
+               Bit depth of the normalized log, the 
+               same as in `image_logarizer`. Default 
+               is 64
+                
+    Returns
+    -------
+    sobel_mag: ndarray
+               3x3 Sobel Filter Magnitude of the 
+               logarized image
+                
+    Notes
+    -----
+    This gives the same magnitude as running `sobel` 
+    on the output of `image_logarizer`, but the log
+    and the 3x3 Sobel are calculated together in a 
+    single pass by `numba_log_sobel` - so the log 
+    image is never written out, and the Sobel angle, 
+    which is usually discarded, is not calculated.
+    
+    See Also
+    --------
+    sobel
+    image_logarizer
+    numba_log_sobel
+    """
+    image = np.ascontiguousarray(image, dtype=np.float64)
+    sobel_mag = np.empty_like(image)
+    data_min = np.amin(image)
+    data_range = np.amax(image) - data_min
+    bit_scale = float((2 ** bit_depth) - 1)
+    numba_log_sobel(image, sobel_mag, data_min, data_range, bit_scale)
+    return sobel_mag
+
+
+@numba.jit(parallel=True, cache=True)
+def numba_log_sobel(image, sobel_mag, data_min, data_range, bit_scale):
+    """
+    Numba JIT Function for the fused log and
+    3x3 Sobel magnitude
+    
+    Parameters
+    ----------
+    image:      ndarray
+                Input image
+    sobel_mag:  ndarray
+                Sobel magnitude of the log image, 
+                that is written in place
+    data_min:   float
+                Minimum of the image
+    data_range: float
+                Range of the image
+    bit_scale:  float
+                Scale of the normalized image
+                before the log is taken
+    
+    Notes
+    -----
+    The image rows are split into blocks, which are
+    filtered in parallel. For each block, the log of
+    its rows and the row on either side is calculated
+    once into a small buffer, from which the Sobel 
+    gradients are calculated. The image edges are 
+    extended by the nearest pixels, which for a 3x3 
+    filter is the same as reflecting them.
+    """
+    rows, cols = image.shape
+    block_rows = 16
+    no_blocks = (rows + block_rows - 1) // block_rows
+    for bb in numba.prange(no_blocks):
+        start = bb * block_rows
+        stop = min(start + block_rows, rows)
+        log_rows = np.empty((stop - start + 2, cols))
+        for ii in range(stop - start + 2):
+            yy = min(max(start + ii - 1, 0), rows - 1)
+            for jj in range(cols):
+                log_rows[ii, jj] = math.log2(
+                    1 + (bit_scale * ((image[yy, jj] - data_min) / data_range))
+                )
+        for ii in range(1, stop - start + 1):
+            for jj in range(cols):
+                jl = max(jj - 1, 0)
+                jr = min(jj + 1, cols - 1)
+                g_x = (
+                    (log_rows[ii - 1, jr] - log_rows[ii - 1, jl])
+                    + (2 * (log_rows[ii, jr] - log_rows[ii, jl]))
+                    + (log_rows[ii + 1, jr] - log_rows[ii + 1, jl])
+                )
+                g_y = (
+                    (log_rows[ii + 1, jl] - log_rows[ii - 1, jl])
+                    + (2 * (log_rows[ii + 1, jj] - log_rows[ii - 1, jj]))
+                    + (log_rows[ii + 1, jr] - log_rows[ii - 1, jr])
+                )
+                sobel_mag[start + ii - 1, jj] = math.sqrt((g_x ** 2) + (g_y ** 2))
+
+
 def circle_fit(edge_image):
     """
     Fit circle to data points algebraically